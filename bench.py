@@ -0,0 +1,391 @@
+"""Benchmarks on a tiny randomly-initialized MiniCPMV, small enough for a cpu-only box.
+
+The model code is taken from this repo's modeling_minicpmv.py, the rest of the remote code
+(configuration_minicpm.py, modeling_minicpm.py, resampler.py) and the tokenizer from a local
+MiniCPM-V snapshot, so no network access is needed.
+
+python bench.py --model_dir ~/.cache/huggingface/hub/models--openbmb--MiniCPM-V/snapshots/<rev> --out save/bench.json
+python bench.py --model_dir ... --out save/bench_new.json --compare save/bench.json
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+TINY_CONFIG = {
+    'hidden_size': 256,
+    'num_hidden_layers': 2,
+    'num_attention_heads': 4,
+    'num_key_value_heads': 4,
+    'intermediate_size': 512,
+    'query_num': 16,
+    'image_size': 224,
+    'vision_encoder': 'vit_tiny_patch16_224',
+    'drop_vision_last_layer': False,
+}
+
+EN_WORDS = 'a the man woman dog cat red blue small large sits on in with street table holding near park water'.split()
+
+
+def timeit(fn, repeat=5, warmup=1):
+    """median wall time of fn() in seconds"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+
+def load_remote_code(model_dir):
+    # same layout as the transformers_modules cache: snapshot code + our modeling_minicpmv.py
+    root = tempfile.mkdtemp()
+    pkg = os.path.join(root, 'minicpmv_bench')
+    os.mkdir(pkg)
+    for fname in os.listdir(model_dir):
+        if fname.endswith('.py'):
+            shutil.copy(os.path.join(model_dir, fname), pkg)
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modeling_minicpmv.py'), pkg)
+    open(os.path.join(pkg, '__init__.py'), 'w').close()
+    sys.path.insert(0, root)
+    return importlib.import_module('minicpmv_bench.modeling_minicpmv'), importlib.import_module('minicpmv_bench.configuration_minicpm')
+
+
+def tiny_model(model_dir, seed=0):
+    modeling, configuration = load_remote_code(model_dir)
+    config = configuration.MiniCPMVConfig.from_pretrained(model_dir)
+    for k, v in TINY_CONFIG.items():
+        setattr(config, k, v)
+    torch.manual_seed(seed)
+    model = modeling.MiniCPMV(config).eval()
+    tokenizer = modeling.LlamaTokenizerWrapper.from_pretrained(model_dir)
+    return model, tokenizer, modeling
+
+
+def ban_stop_tokens(model, tokenizer):
+    # random weights stop at arbitrary steps, this makes Chat run for exactly max_new_tokens
+    banned = [0, tokenizer.eos_id, tokenizer.bos_id]
+    def hook(module, inputs, output):
+        output.logits[..., banned] = float('-inf')
+    return model.llm.register_forward_hook(hook)
+
+
+def random_image(size, seed=0):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+
+
+def random_en(rng, n_words):
+    return ' '.join(rng.choice(EN_WORDS) for _ in range(n_words))
+
+
+def random_zh(rng, n_chars):
+    return ''.join(chr(rng.randint(0x4e00, 0x4e00 + 200)) for _ in range(n_chars))
+
+
+def bench_chat(model, tokenizer, lengths=(4, 16, 64)):
+    """seconds per generated token of Chat vs output length (vision states precomputed)"""
+    image = random_image(model.config.image_size)
+    handle = ban_stop_tokens(model, tokenizer)
+    _, vision_hidden_states = model.Chat(image=image, src_text='a dog on the street', tokenizer=tokenizer,
+                                         tgt_lang='zh', txt_hp=0.03, max_new_tokens=1)
+    res = {}
+    for n in lengths:
+        t = timeit(lambda: model.Chat(image=image, src_text='a dog on the street', tokenizer=tokenizer, tgt_lang='zh',
+                                      txt_hp=0.03, vision_hidden_states=vision_hidden_states, max_new_tokens=n),
+                   repeat=3)
+        res[n] = t / n
+    handle.remove()
+    return res
+
+
+def bench_stream(model, tokenizer, n_tokens=16):
+    """seconds to the first streamed token and per token after it"""
+    image = random_image(model.config.image_size)
+    handle = ban_stop_tokens(model, tokenizer)
+    vision_hidden_states = model.encode_image(image)
+
+    def run():
+        t = time.perf_counter()
+        stream = model.Chat_stream(image=image, src_text='a dog on the street', tokenizer=tokenizer, tgt_lang='zh',
+                                   txt_hp=0.03, vision_hidden_states=vision_hidden_states, max_new_tokens=n_tokens)
+        next(stream)
+        first = time.perf_counter() - t
+        for _ in stream:
+            pass
+        return first, (time.perf_counter() - t - first) / (n_tokens - 1)
+
+    run()
+    times = [run() for _ in range(3)]
+    handle.remove()
+    return {'first_token': float(np.median([t[0] for t in times])), 'per_token': float(np.median([t[1] for t in times]))}
+
+
+def bench_beam(model, tokenizer, beams=(2, 3, 5), n_tokens=16):
+    """seconds per generated token of contrastive beam search vs number of beams"""
+    image = random_image(model.config.image_size)
+    handle = ban_stop_tokens(model, tokenizer)
+    vision_hidden_states = model.encode_image(image)
+    res = {}
+    for k in beams:
+        t = timeit(lambda: model.Chat(image=image, src_text='a dog on the street', tokenizer=tokenizer, tgt_lang='zh',
+                                      txt_hp=0.03, vision_hidden_states=vision_hidden_states, max_new_tokens=n_tokens,
+                                      num_beams=k),
+                   repeat=3)
+        res[k] = t / n_tokens
+    handle.remove()
+    return res
+
+
+def bench_prefix_cache(model, tokenizer, n_hp=5, n_tokens=4):
+    """seconds for an hp sweep on one image with the three-way contrast, with and without a prefix cache"""
+    image = random_image(model.config.image_size)
+    handle = ban_stop_tokens(model, tokenizer)
+    vision_hidden_states = model.encode_image(image)
+
+    # first-step logits through a reused cache match a plain prefill, also when the cache was built on another image
+    prefix_cache = {}
+    with torch.inference_mode():
+        for vhs in [model.encode_image(random_image(model.config.image_size, seed=1)), vision_hidden_states]:
+            for tgt_lang, src_text in [('zh', 'a dog on the street'), ('zh', 'a cat on the table')]:
+                prompts = model._chat_prompts(src_text, tokenizer, tgt_lang)
+                ref = model._prefill_chat(tokenizer, prompts, vhs, img_contrast=True)[0]
+                got = model._prefill_chat(tokenizer, prompts, vhs, img_contrast=True, prefix_cache=prefix_cache)[0]
+                assert torch.allclose(ref, got, atol=1e-3), (ref - got).abs().max()
+
+    def sweep(use_cache):
+        prefix_cache = {} if use_cache else None
+        for tgt_lang, src_text in [('zh', 'a dog on the street'), ('en', '街上的一只狗')]:
+            for hp_i in range(n_hp):
+                model.Chat(image=image, src_text=src_text, tokenizer=tokenizer, tgt_lang=tgt_lang, txt_hp=hp_i * 0.01,
+                           img_hp=hp_i * 0.01, vision_hidden_states=vision_hidden_states, max_new_tokens=n_tokens,
+                           img_contrast=True, prefix_cache=prefix_cache)
+
+    res = {'no_cache': timeit(lambda: sweep(False), repeat=3), 'cache': timeit(lambda: sweep(True), repeat=3)}
+    handle.remove()
+    return res
+
+
+def bench_batch(model, tokenizer, modeling, n_start=2, n_join=1, n_tokens=8):
+    """seconds per ContrastBatch.step, with n_join requests joining after the first step of n_start"""
+    image = random_image(model.config.image_size)
+    handle = ban_stop_tokens(model, tokenizer)
+    vision_hidden_states = model.encode_image(image)
+    rng = random.Random(0)
+    requests = [{'key': i, 'image': image, 'src_text': random_en(rng, rng.randint(3, 10)), 'tgt_lang': 'zh',
+                 'txt_hp': 0.03 * i, 'vision_hidden_states': vision_hidden_states} for i in range(n_start + n_join)]
+
+    def run():
+        batch = modeling.ContrastBatch(model, tokenizer, max_new_tokens=n_tokens)
+        batch.add(requests[:n_start])
+        finished = batch.step()
+        batch.add(requests[n_start:])
+        n_steps = 1
+        while len(batch):
+            finished += batch.step()
+            n_steps += 1
+        # every request decodes exactly n_tokens, including the one that joined mid-batch
+        assert sorted(key for key, _ in finished) == list(range(n_start + n_join)), finished
+        return n_steps
+
+    n_steps = run()
+    res = {'per_step': timeit(run, repeat=3) / n_steps}
+    handle.remove()
+    return res
+
+
+def bench_vision(model, batch_sizes=(1, 2, 4, 8)):
+    """seconds per get_vision_embedding call vs batch size"""
+    res = {}
+    size = model.config.image_size
+    for bs in batch_sizes:
+        pixel_values = torch.randn(bs, 3, size, size)
+        with torch.inference_mode():
+            res[bs] = timeit(lambda: model.get_vision_embedding(pixel_values))
+    return res
+
+
+def bench_pixels(model, src_size=800):
+    """seconds per image to get pixel values from a jpeg (decode + transform) vs a preprocessed uint8 array"""
+    from preprocess import resize
+
+    buf = io.BytesIO()
+    random_image(src_size).save(buf, format='JPEG')
+    jpeg = buf.getvalue()
+    pixels = resize(Image.open(io.BytesIO(jpeg)), model.config.image_size)
+    return {
+        'jpeg': timeit(lambda: model._to_pixel_values(Image.open(io.BytesIO(jpeg)).convert('RGB'))),
+        'uint8': timeit(lambda: model._to_pixel_values(pixels)),
+    }
+
+
+def bench_onnx_vision(model, batch_sizes=(1, 4, 8)):
+    """seconds per image of the vision path, eager vs onnx runtime, plus parity"""
+    from onnx_vision import OnnxVisionEncoder, check_parity, export_vision
+
+    path = os.path.join(tempfile.mkdtemp(), 'vision.onnx')
+    export_vision(model, path)
+    backend = OnnxVisionEncoder(path)
+    res = {'max_abs': check_parity(model, backend)['max_abs']}
+    size = model.config.image_size
+    for bs in batch_sizes:
+        pixel_values = torch.randn(bs, 3, size, size)
+        with torch.inference_mode():
+            res[f'eager-{bs}'] = timeit(lambda: model.get_vision_embedding(pixel_values, backend='eager')) / bs
+            res[f'onnx-{bs}'] = timeit(lambda: model.get_vision_embedding(pixel_values, backend=backend)) / bs
+    shutil.rmtree(os.path.dirname(path))
+    return res
+
+
+def bench_process_list(model, tokenizer, batch_sizes=(1, 4, 16, 64)):
+    """seconds per _process_list call vs batch size, on Chat-like prompts"""
+    rng = random.Random(0)
+    pre_prompt = tokenizer.im_start + tokenizer.unk_token * model.config.query_num + tokenizer.im_end + '\n<用户>'
+    res = {}
+    for bs in batch_sizes:
+        data_list = [pre_prompt + f'翻译成中文：{random_en(rng, rng.randint(5, 30))}' + '\n<AI>' for _ in range(bs)]
+        res[bs] = timeit(lambda: model._process_list(tokenizer, data_list, 2048))
+    return res
+
+
+def bench_pad(modeling, batch_sizes=(1, 4, 16, 64)):
+    """seconds per pad call vs batch size, on ragged int32 rows"""
+    rng = random.Random(0)
+    res = {}
+    for bs in batch_sizes:
+        items = [{'input_ids': torch.randint(0, 1000, (1, rng.randint(50, 120)), dtype=torch.int32)} for _ in range(bs)]
+        res[bs] = timeit(lambda: modeling.pad(items, 'input_ids', padding_side='left'))
+    return res
+
+
+def bench_cider(corpus_sizes=(100, 1000)):
+    """seconds per CiderScorer.compute_score vs corpus size, en and zh (includes cooking)"""
+    from cider import Cider
+
+    rng = random.Random(0)
+    res = {}
+    for lang, gen in [('en', random_en), ('zh', random_zh)]:
+        for n in corpus_sizes:
+            gts = {i: [gen(rng, rng.randint(8, 20)) for _ in range(2)] for i in range(n)}
+            hyp = {i: gen(rng, rng.randint(8, 20)) for i in range(n)}
+            cider = Cider(lang=lang)
+            res[f'{lang}-{n}'] = timeit(lambda: cider.compute_score(gts, hyp), repeat=3)
+    return res
+
+
+def bench_bootstrap(n_items=(100, 1000, 10000), n_hp=10, n_resamples=1000):
+    """seconds for paired bootstrap over all hp pairs of both directions vs number of images"""
+    from significance import compare_hps
+
+    rng = np.random.default_rng(0)
+    res = {}
+    for n in n_items:
+        img_scores = {d: {hp_i: rng.random(n) for hp_i in range(n_hp)} for d in [('en', 'zh'), ('zh', 'en')]}
+        res[n] = timeit(lambda: compare_hps(img_scores, n_resamples=n_resamples), repeat=3)
+    return res
+
+
+def bench_caption_lookup(n_imgs=(1000, 10000), n_lookups=200):
+    """seconds per eval.get_caption call vs captions.jsonl size (the first, loading call is the warmup)"""
+    rng = random.Random(0)
+    res = {}
+    cwd = os.getcwd()
+    for n in n_imgs:
+        tmp = tempfile.mkdtemp()
+        with open(os.path.join(tmp, 'captions.jsonl'), 'w') as f:
+            for i in range(n):
+                f.write(json.dumps({
+                    'image/key': f'{i:016x}',
+                    'image/locale': rng.choice(['en', 'zh']),
+                    'en': {'caption': [random_en(rng, 10)]},
+                    'zh': {'caption': [random_zh(rng, 10)]},
+                }, ensure_ascii=False) + '\n')
+        os.chdir(tmp)
+        try:
+            sys.modules.pop('eval', None)
+            sys.modules.pop('captions', None)
+            import eval as eval_mod
+            keys = [f'{rng.randrange(n):016x}' for _ in range(n_lookups)]
+            res[n] = timeit(lambda: [eval_mod.get_caption(k, 'en') for k in keys], repeat=3) / n_lookups
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp)
+    return res
+
+
+def compare(new, old):
+    for name in new:
+        if name == 'meta' or name not in old:
+            continue
+        for k, t in new[name].items():
+            if k not in old[name]:
+                continue
+            ratio = t / old[name][k] if old[name][k] > 0 else float('inf')
+            flag = ' <-- slower' if ratio > 1.1 else ''
+            print(f'{name:>14} {k:>10} {old[name][k] * 1000:10.3f} ms -> {t * 1000:10.3f} ms  x{ratio:.2f}{flag}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', default=None, help='local MiniCPM-V snapshot, model benchmarks are skipped without it')
+    parser.add_argument('--only', nargs='*', default=None, help='subset of benchmark names to run')
+    parser.add_argument('--out', default='save/bench.json')
+    parser.add_argument('--compare', default=None, help='earlier --out file to compare against')
+    args = parser.parse_args()
+
+    torch.set_num_threads(max(1, os.cpu_count() // 2))
+    benches = {
+        'cider': bench_cider,
+        'bootstrap': bench_bootstrap,
+        'caption_lookup': bench_caption_lookup,
+    }
+    if args.model_dir is not None:
+        model, tokenizer, modeling = tiny_model(args.model_dir)
+        benches.update({
+            'chat': lambda: bench_chat(model, tokenizer),
+            'stream': lambda: bench_stream(model, tokenizer),
+            'beam': lambda: bench_beam(model, tokenizer),
+            'prefix_cache': lambda: bench_prefix_cache(model, tokenizer),
+            'batch': lambda: bench_batch(model, tokenizer, modeling),
+            'vision': lambda: bench_vision(model),
+            'onnx_vision': lambda: bench_onnx_vision(model),
+            'pixels': lambda: bench_pixels(model),
+            'process_list': lambda: bench_process_list(model, tokenizer),
+            'pad': lambda: bench_pad(modeling),
+        })
+
+    res = {'meta': {'torch': torch.__version__, 'threads': torch.get_num_threads(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}}
+    for name, fn in benches.items():
+        if args.only is not None and name not in args.only:
+            continue
+        print('running', name)
+        try:
+            res[name] = {str(k): v for k, v in fn().items()}
+        except ImportError as e:
+            print('skipped', name, e)
+            continue
+        print(name, res[name])
+
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(res, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(res, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
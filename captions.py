@@ -0,0 +1,60 @@
+import json
+import os
+import pickle
+import tempfile
+
+_captions = {} # path -> {img_id -> {'locale': ..., lang -> [captions]}}
+
+
+def load_captions(path='captions.jsonl'):
+    """
+    Parses captions.jsonl on first use only. The parsed dict is cached as a pickle next to the
+    jsonl, which later processes load instead of re-parsing; it is rebuilt when the jsonl is newer.
+    """
+    if path in _captions:
+        return _captions[path]
+
+    cache = os.path.splitext(path)[0] + '.pkl'
+    captions = None
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        try:
+            with open(cache, 'rb') as f:
+                captions = pickle.load(f)
+        except Exception:
+            # e.g. truncated by a killed writer, rebuilt below
+            captions = None
+    if captions is None:
+        captions = {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                entry = {k: v['caption'] for k, v in row.items() if isinstance(v, dict) and 'caption' in v}
+                entry['locale'] = row['image/locale']
+                # first row wins for repeated keys, like the pandas lookup did
+                captions.setdefault(row['image/key'], entry)
+        # unique temp file per process, parallel jobs may rebuild the cache at the same time
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(captions, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    _captions[path] = captions
+    return captions
+
+
+def get_captions(img_id, lang):
+    return load_captions()[img_id][lang]
+
+
+def get_caption(img_id, lang, idx=0):
+    return load_captions()[img_id][lang][idx]
+
+
+def get_img_lang(img_id):
+    return load_captions()[img_id]['locale']
@@ -6,7 +6,6 @@ import copy
 from collections import defaultdict
 import numpy as np
 import math
-import jieba
 
 class CiderScorer(object):
     # moved cook stuff inside the class
@@ -20,7 +19,12 @@ class CiderScorer(object):
         :param n: int    : number of ngrams for which representation is calculated
         :return: term frequency vector for occuring ngrams
         """
-        words = s.split() if self.lang == 'en' else list(jieba.cut(s))
+        if self.lang == 'en':
+            words = s.split()
+        else:
+            # slow to import, only needed for zh
+            import jieba
+            words = list(jieba.cut(s))
         # words = s.split() if self.lang == 'en' else list(s)
         counts = defaultdict(int)
         for k in range(1,n+1):
@@ -1,19 +1,11 @@
 import pickle
 import os
-import pandas as pd
-from comet import download_model, load_from_checkpoint
 
 from cider import Cider
+# captions.jsonl is read on first lookup, comet is imported in init_comet
+from captions import get_captions, get_caption, get_img_lang
 
-cap_jsonl = pd.read_json('captions.jsonl', lines=True)
-def get_captions(img_id, lang):
-    return cap_jsonl[cap_jsonl['image/key'] == img_id][lang].iloc[0]['caption']
-def get_caption(img_id, lang, idx=0):
-    return cap_jsonl[cap_jsonl['image/key'] == img_id][lang].iloc[0]['caption'][idx]
-def get_img_lang(img_id):
-    return cap_jsonl[cap_jsonl['image/key'] == img_id]['image/locale'].iloc[0]
-
-def eval_cider(fname, n_hp, lang_filter=None):
+def eval_cider(fname, n_hp, lang_filter=None, return_img_scores=False):
     # read run.py results
     with open('save/' + fname + '.pkl', 'rb') as f:
         # direction -> {hp_i -> {img_id -> res}}
@@ -22,6 +14,7 @@ def eval_cider(fname, n_hp, lang_filter=None):
     dirs = [('en', 'zh'), ('zh', 'en')]
     ciders = {d[1]: Cider(lang=d[1]) for d in dirs}
     scores = {d: {} for d in dirs} # direction -> {hp_i -> score}
+    img_scores = {d: {} for d in dirs} # direction -> {hp_i -> per-image scores in filtered_img_ids order}
     if lang_filter is None:
         filtered_img_ids = list(res[dirs[0]][0].keys())
     else:
@@ -44,19 +37,24 @@ def eval_cider(fname, n_hp, lang_filter=None):
 
             score, returned_scores = ciders[tgt_lang].compute_score(ref_caps[tgt_lang], res[dirn][hp_i])
             scores[dirn][hp_i] = score
+            img_scores[dirn][hp_i] = returned_scores
             # print('direction', dirn, 'hp_i', hp_i, 'score', score)
 
     # with open('save/scores3.pkl', 'wb') as f:
     #     pickle.dump(scores, f)
 
+    if return_img_scores:
+        return scores, img_scores
     return scores
 
 def init_comet():
+    from comet import download_model, load_from_checkpoint
+
     global model
     model_path = download_model("Unbabel/wmt22-comet-da")
     model = load_from_checkpoint(model_path)
 
-def eval_comet(fname, n_hp, lang_filter=None):
+def eval_comet(fname, n_hp, lang_filter=None, return_img_scores=False):
     # read run.py results
     with open('save/' + fname + '.pkl', 'rb') as f:
         # direction -> {hp_i -> {img_id -> res}}
@@ -69,6 +67,7 @@ def eval_comet(fname, n_hp, lang_filter=None):
 
     dirs = [('en', 'zh'), ('zh', 'en')]
     scores = {d: {} for d in dirs} # direction -> {hp_i -> score}
+    img_scores = {d: {} for d in dirs} # direction -> {hp_i -> segment scores in filtered_img_ids order}
     if lang_filter is None:
         filtered_img_ids = list(res[dirs[0]][0].keys())
     else:
@@ -93,10 +92,14 @@ def eval_comet(fname, n_hp, lang_filter=None):
         src_lang, tgt_lang = d
         # for hp_i in res[dirn]:
         for hp_i in range(n_hp):
-            scores[d][hp_i] = model.predict(caps[d][hp_i], batch_size=8, gpus=1).system_score
+            output = model.predict(caps[d][hp_i], batch_size=8, gpus=1)
+            scores[d][hp_i] = output.system_score
+            img_scores[d][hp_i] = output.scores
             print('direction', d, 'hp_i', hp_i, 'score', scores[d][hp_i])
 
     # with open('save/scores3.pkl', 'wb') as f:
     #     pickle.dump(scores, f)
 
+    if return_img_scores:
+        return scores, img_scores
     return scores
\ No newline at end of file
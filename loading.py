@@ -0,0 +1,88 @@
+import glob
+import os
+import time
+
+import torch
+from transformers import AutoConfig, AutoModel, GenerationConfig
+from transformers.dynamic_module_utils import get_class_from_dynamic_module
+
+
+def resolve(name_or_path):
+    if os.path.isdir(name_or_path):
+        return name_or_path
+    from huggingface_hub import snapshot_download
+
+    try:
+        return snapshot_download(name_or_path, local_files_only=True)
+    except Exception:
+        return snapshot_download(name_or_path)
+
+
+def check_code(model_class):
+    # a snapshot directory as name_or_path makes transformers copy the stock hub modeling_minicpmv.py
+    assert hasattr(model_class, 'encode_image'), \
+        f'{model_class.__module__} is not this repo\'s modeling_minicpmv.py, load from the hub id instead of a local snapshot'
+
+
+def fast_load(name_or_path='openbmb/MiniCPM-V', device='cuda:0', dtype=torch.bfloat16):
+    """
+    Loads the model with its safetensors weights read straight onto device in dtype, into a skeleton
+    whose parameters were never allocated or randomly initialized (so timm.create_model and
+    init_resampler cost almost nothing). Falls back to from_pretrained + .to() without safetensors.
+    Config and model class come from name_or_path as given, like from_pretrained(name_or_path), so a hub
+    id uses the edited code in transformers_modules; the snapshot is only used to find the weights.
+    :return: model, timings (step -> seconds)
+    """
+    times = {}
+    t = time.perf_counter()
+    def lap(name):
+        nonlocal t
+        now = time.perf_counter()
+        times[name] = now - t
+        t = now
+
+    path = resolve(name_or_path)
+    lap('resolve')
+    files = sorted(glob.glob(os.path.join(path, '*.safetensors')))
+    if not files:
+        model = AutoModel.from_pretrained(name_or_path, trust_remote_code=True, torch_dtype=dtype)
+        check_code(type(model))
+        lap('from_pretrained')
+        model = model.to(device=device, dtype=dtype)
+        lap('to_device')
+        return model.eval(), times
+
+    from accelerate import init_empty_weights
+    from safetensors import safe_open
+    from transformers.modeling_utils import no_init_weights
+
+    config = AutoConfig.from_pretrained(name_or_path, trust_remote_code=True)
+    model_class = get_class_from_dynamic_module(config.auto_map['AutoModel'], name_or_path)
+    check_code(model_class)
+    lap('config')
+
+    # parameters on the meta device, buffers (rotary caches etc.) are still built since they are not in the checkpoint
+    with init_empty_weights(include_buffers=False), no_init_weights():
+        model = model_class(config)
+    lap('init')
+
+    state_dict = {}
+    for fname in files:
+        with safe_open(fname, framework='pt', device=str(device)) as f:
+            for k in f.keys():
+                tensor = f.get_tensor(k)
+                state_dict[k] = tensor.to(dtype) if tensor.is_floating_point() else tensor
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    missing = [k for k, p in model.named_parameters() if p.is_meta]
+    assert not missing, f'not in checkpoint: {missing[:10]}'
+    lap('weights')
+
+    # moves the buffers, parameters are already in place
+    model = model.to(device=device, dtype=dtype)
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(name_or_path)
+    except OSError:
+        pass
+    lap('to_device')
+    return model.eval(), times
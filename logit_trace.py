@@ -0,0 +1,96 @@
+import json
+
+import numpy as np
+import torch
+
+
+class LogitTrace:
+    """
+    Per-step record of greedy Chat decisions for offline analysis: top-k ids and logprobs of the
+    expert (before the plausibility mask), of the txt and img amateurs (as used in the contrast; ids -1
+    and logprobs 0 without img_contrast), the plausibility mask size and the chosen token. Pass one to
+    every Chat(trace=...) of a run, save() once at the end. Entries of context (e.g. img_id) are stored
+    with each sequence.
+
+    """
+    def __init__(self, k=20):
+        self.k = k
+        self.context = {}
+        self.meta = [] # one dict per sequence
+        self.offsets = [0] # sequence i is steps offsets[i]:offsets[i + 1]
+        self.arrays = {'exp_ids': [], 'exp_lp': [], 'txt_ids': [], 'txt_lp': [], 'img_ids': [], 'img_lp': [],
+                       'mask_size': [], 'chosen': []}
+        self._steps = []
+
+    def begin(self, **meta):
+        self.meta.append({**self.context, **meta})
+        self._steps = []
+
+    def record(self, logprobs_exp, logprobs_txt, mask_size, chosen, logprobs_img=None):
+        # stays on device until end() so tracing does not sync every step
+        exp_lp, exp_ids = logprobs_exp.float().topk(self.k)
+        txt_lp, txt_ids = logprobs_txt.float().topk(self.k)
+        if logprobs_img is None:
+            # no img amateur, contributes nothing when rescored
+            img_lp, img_ids = torch.zeros_like(txt_lp), torch.full_like(txt_ids, -1)
+        else:
+            img_lp, img_ids = logprobs_img.float().topk(self.k)
+        self._steps.append((exp_ids, exp_lp, txt_ids, txt_lp, img_ids, img_lp, torch.as_tensor(mask_size), torch.as_tensor(chosen)))
+
+    def end(self):
+        if self._steps:
+            for name, values, dtype in zip(
+                    ['exp_ids', 'exp_lp', 'txt_ids', 'txt_lp', 'img_ids', 'img_lp', 'mask_size', 'chosen'], zip(*self._steps),
+                    [np.int32, np.float16, np.int32, np.float16, np.int32, np.float16, np.int32, np.int32]):
+                self.arrays[name].append(torch.stack([v.to(values[0].device) for v in values]).cpu().numpy().astype(dtype))
+        self.offsets.append(self.offsets[-1] + len(self._steps))
+        self._steps = []
+
+    def save(self, path):
+        arrays = {}
+        for name, parts in self.arrays.items():
+            if parts:
+                arrays[name] = np.concatenate(parts)
+            else:
+                arrays[name] = np.zeros((0, self.k) if name.endswith(('_ids', '_lp')) else (0,),
+                                        dtype=np.float16 if name.endswith('_lp') else np.int32)
+        np.savez(path, offsets=np.array(self.offsets, dtype=np.int64), meta=np.array(json.dumps(self.meta)), **arrays)
+
+
+def load_trace(path):
+    data = np.load(path)
+    res = {k: data[k] for k in data.files}
+    res['meta'] = json.loads(str(res['meta']))
+    return res
+
+
+def amateur_for_exp(exp_ids, ids, lp):
+    # amateur logprob of each expert candidate, its k-th logprob when outside its top-k
+    match = exp_ids[:, :, None] == ids[:, None, :] # (n_steps, k, k)
+    return np.where(match.any(-1), (match * lp[:, None, :]).sum(-1), lp[:, -1:])
+
+
+def rescore(trace, txt_hp, plaus_hp=0.1, img_hp=0.0):
+    """
+    Approximate greedy choices under other contrast settings from the recorded top-k only, no model
+    forward. Candidates are the expert's top-k; an amateur logprob outside its own top-k is taken as its
+    k-th logprob. img_hp only acts on sequences decoded with img_contrast. A sequence is only comparable
+    up to its first step whose choice differs, since the model would have seen a different prefix afterwards.
+    :return: chosen ids (n_steps,), first differing step per sequence (-1 if none)
+    """
+    exp_ids, exp_lp = trace['exp_ids'], trace['exp_lp'].astype(np.float32)
+
+    amateur = txt_hp * amateur_for_exp(exp_ids, trace['txt_ids'], trace['txt_lp'].astype(np.float32))
+    if img_hp:
+        amateur = amateur + img_hp * amateur_for_exp(exp_ids, trace['img_ids'], trace['img_lp'].astype(np.float32))
+    plausible = exp_lp >= exp_lp[:, :1] + np.log(plaus_hp)
+    scores = np.where(plausible, exp_lp - amateur, -np.inf)
+    chosen = exp_ids[np.arange(len(exp_ids)), scores.argmax(-1)]
+
+    differs = chosen != trace['chosen']
+    offsets = trace['offsets']
+    first = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        idx = np.flatnonzero(differs[start:end])
+        first.append(int(idx[0]) if len(idx) else -1)
+    return chosen, np.array(first)
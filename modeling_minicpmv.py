@@ -1,7 +1,9 @@
 import math
+from contextlib import nullcontext
 from typing import List, Optional
 import json
 
+import numpy as np
 import timm
 import torch
 import torch.nn.functional as F
@@ -31,6 +33,10 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
         self.transform = self.init_transform()
 
         self.plaus_hp = 0.1
+        # optional profiler.Profiler, set for the duration of a Chat call
+        self.profiler = None
+        # optional batched replacement for vpm + resampler, e.g. onnx_vision.OnnxVisionEncoder
+        self.vision_backend = None
         # self.txt_hp = 0.5
         # self.img_hp = 0.5
         # print('plaus_hp', self.plaus_hp, 'txt_hp', self.txt_hp, 'img_hp', self.img_hp)
@@ -71,16 +77,54 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
             transforms.Normalize(mean=IMAGENET_INCEPTION_MEAN, std=IMAGENET_INCEPTION_STD)
         ])
 
+    def _to_pixel_values(self, img):
+        # uint8 (h, w, 3) arrays from preprocess.PixelStore are already resized, only normalize them on device
+        if isinstance(img, (np.ndarray, torch.Tensor)):
+            assert tuple(img.shape) == (self.config.image_size, self.config.image_size, 3), img.shape
+            pixels = torch.as_tensor(img).to(self.device, non_blocking=True)
+            pixels = pixels.permute(2, 0, 1).float().div_(255)
+            return transforms.functional.normalize(pixels, mean=IMAGENET_INCEPTION_MEAN, std=IMAGENET_INCEPTION_STD)
+        return self.transform(img)
+
+    def _stage(self, name):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.stage(name)
+
+    def offload_vision(self, device='cpu'):
+        """
+        Moves vpm and resampler off the accelerator once all images are encoded, so decoding runs
+        with only the llm resident. Each module is moved back on its next use.
+        """
+        self.vpm.to(device)
+        self.resampler.to(device)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _load_module(self, module):
+        # undo offload_vision lazily
+        if next(module.parameters()).device != self.device:
+            with self._stage('load'):
+                module.to(self.device)
+        return module
+
+    def get_vision_embedding(self, pixel_values, backend=None):
+        """
+        :param backend: 'eager' for vpm + resampler, or a callable on the whole batch; defaults to self.vision_backend
+        """
+        backend = backend or self.vision_backend
+        if backend is not None and backend != 'eager':
+            dtype = self.llm.model.embed_tokens.weight.dtype
+            return backend(pixel_values).to(device=self.device, dtype=dtype)
 
-
-    def get_vision_embedding(self, pixel_values):
         res = []
-        dtype = self.vpm.pos_embed.data.dtype
+        vpm = self._load_module(self.vpm)
+        dtype = vpm.pos_embed.data.dtype
         for pixel_value in pixel_values:
-            vision_embedding = self.vpm.forward_features(pixel_value.unsqueeze(0).type(dtype))
-            if hasattr(self.vpm, 'num_prefix_tokens') and self.vpm.num_prefix_tokens > 0:
-                vision_embedding = vision_embedding[:, self.vpm.num_prefix_tokens:]
-            res.append(self.resampler(vision_embedding))
+            vision_embedding = vpm.forward_features(pixel_value.unsqueeze(0).type(dtype))
+            if hasattr(vpm, 'num_prefix_tokens') and vpm.num_prefix_tokens > 0:
+                vision_embedding = vision_embedding[:, vpm.num_prefix_tokens:]
+            res.append(self._load_module(self.resampler)(vision_embedding))
         return torch.vstack(res)
 
     def get_vllm_embedding(self, data):
@@ -89,10 +133,11 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
             vision_hidden_states = []
             for pixel_values in pixel_values_list:
                 if len(pixel_values) > 0:
-                    vision_hidden_states.append(self.get_vision_embedding(pixel_values))
+                    with self._stage('vision'):
+                        vision_hidden_states.append(self.get_vision_embedding(pixel_values))
                 elif self.training:
                     dtype = self.vpm.pos_embed.data.dtype
-                    device = self.vpm.pos_embed.data.device
+                    device = self.device
                     dummy_image = torch.zeros(
                         (1, 3, 224, 224),
                         device=device, dtype=dtype
@@ -140,42 +185,47 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
         )
 
 
-    def _convert_to_tensors(self, tokenizer, input_str, max_inp_length: Optional[int] = None):
-        if tokenizer.add_bos_token:
-            input_ids = tokenizer.encode(input_str)
-        else:
-            input_ids = [tokenizer.bos_id] + tokenizer.encode(input_str)
-        if max_inp_length is not None:
-            input_ids = input_ids[: max_inp_length]
-        input_ids = torch.tensor(input_ids, dtype=torch.int32)
-
-        image_start_tokens = torch.where(input_ids == tokenizer.im_start_id)[0]
-        # 跳过 im_start
-        image_start_tokens += 1
-        image_end_tokens = torch.where(input_ids == tokenizer.im_end_id)[0]
-        valid_image_nums = max(len(image_start_tokens), len(image_end_tokens))
-        image_bound = torch.hstack(
-            [image_start_tokens[: valid_image_nums].unsqueeze(-1),
-             image_end_tokens[:valid_image_nums].unsqueeze(-1)]
-        )
-
-        model_input = {}
-        model_input["input_ids"] = input_ids.unsqueeze(0).to(self.device)
-        model_input["image_bound"] = image_bound
-
-        return model_input
-
-
     def _process_list(self, tokenizer, data_list: List[str], max_inp_length: Optional[int] = None):
-        pad_keys = ['input_ids']
-        input_tensors = []
-        for data in data_list:
-            input_tensors.append(self._convert_to_tensors(tokenizer, data, max_inp_length))
-        padded = {}
-        for key in pad_keys:
-            padded[key] = pad(input_tensors, key, padding_side="left").to(self.device)
-        padded['image_bound'] = [i['image_bound'] for i in input_tensors]
-        return padded
+        """
+        Tokenizes data_list with one tokenizer call and left pads it into one (pinned on cuda) buffer
+        for input_ids and attention_mask, copied to device without blocking; image_bound is per row.
+        """
+        return self._pad_ids(tokenizer, self._tokenize(tokenizer, data_list, max_inp_length))
+
+    def _tokenize(self, tokenizer, data_list: List[str], max_inp_length: Optional[int] = None):
+        ids_list = tokenizer(data_list)['input_ids']
+        if not tokenizer.add_bos_token:
+            ids_list = [[tokenizer.bos_id] + ids for ids in ids_list]
+        if max_inp_length is not None:
+            ids_list = [ids[: max_inp_length] for ids in ids_list]
+        return ids_list
+
+    def _pad_ids(self, tokenizer, ids_list):
+        bs = len(ids_list)
+        lengths = torch.tensor([len(ids) for ids in ids_list])
+        max_length = int(lengths.max())
+        # scatter the concatenated ids into their left-padded positions
+        flat = torch.tensor([i for ids in ids_list for i in ids], dtype=torch.int32)
+        rows = torch.repeat_interleave(torch.arange(bs), lengths)
+        cols = torch.arange(len(flat)) - torch.repeat_interleave(lengths.cumsum(0) - max_length, lengths)
+
+        buf = torch.zeros((2, bs, max_length), dtype=torch.int32, pin_memory=self.device.type == 'cuda')
+        buf[0, rows, cols] = flat
+        buf[1, rows, cols] = 1
+        input_ids = buf[0]
+
+        # image bounds in padded coordinates, im_start itself is skipped
+        image_start = (input_ids == tokenizer.im_start_id).nonzero()
+        image_end = (input_ids == tokenizer.im_end_id).nonzero()
+        image_bound = torch.stack([image_start[:, 1] + 1, image_end[:, 1]], dim=-1)
+        counts = torch.bincount(image_start[:, 0], minlength=bs).tolist()
+
+        buf = buf.to(self.device, non_blocking=True)
+        return {
+            'input_ids': buf[0],
+            'attention_mask': buf[1].long(),
+            'image_bound': list(image_bound.split(counts)),
+        }
 
     def _decode(self, inputs_embeds, tokenizer, **kwargs):
         output = self.llm.generate(
@@ -237,14 +287,15 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
             img_list = [[] for i in range(bs)]
         assert bs == len(img_list)
 
-        model_inputs = self._process_list(tokenizer, data_list, max_inp_length)
+        with self._stage('prompt'):
+            model_inputs = self._process_list(tokenizer, data_list, max_inp_length)
 
         if vision_hidden_states is None:
             pixel_values = []
             for i in range(bs):
                 img_inps = []
                 for img in img_list[i]:
-                    img_inps.append(self.transform(img))
+                    img_inps.append(self._to_pixel_values(img).to(self.device))
                 if img_inps:
                     pixel_values.append(torch.stack(img_inps).to(self.device))
                 else:
@@ -280,14 +331,15 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
             img_list = [[] for i in range(bs)]
         assert bs == len(img_list)
 
-        model_inputs = self._process_list(tokenizer, data_list, max_inp_length)
+        with self._stage('prompt'):
+            model_inputs = self._process_list(tokenizer, data_list, max_inp_length)
 
         if vision_hidden_states is None:
             pixel_values = []
             for i in range(bs):
                 img_inps = []
                 for img in img_list[i]:
-                    img_inps.append(self.transform(img))
+                    img_inps.append(self._to_pixel_values(img).to(self.device))
                 if img_inps:
                     pixel_values.append(torch.stack(img_inps).to(self.device))
                 else:
@@ -306,6 +358,144 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
 
         return result, scores
 
+    def encode_image(self, image):
+        # same format as the vision_hidden_states returned by Generate
+        pixel_values = self._to_pixel_values(image).unsqueeze(0).to(self.device)
+        with torch.inference_mode(), self._stage('vision'):
+            return [self.get_vision_embedding(pixel_values)]
+
+    def _prefill(self, tokenizer, data_list, vision_hidden_states, max_inp_length: Optional[int] = None):
+        """
+        Runs the llm over the left-padded prompts and keeps the kv cache.
+        :param vision_hidden_states: one entry per prompt, [] for prompts without image
+        :return: last position logits (bs, vocab), past_key_values, attention_mask (bs, len)
+        """
+        with self._stage('prompt'):
+            model_inputs = self._process_list(tokenizer, data_list, max_inp_length)
+        model_inputs['vision_hidden_states'] = vision_hidden_states
+        inputs_embeds, _ = self.get_vllm_embedding(model_inputs)
+        attention_mask = model_inputs['attention_mask']
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        output = self.llm(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True
+        )
+        return output.logits[:, -1], output.past_key_values, attention_mask
+
+    def _extend(self, input_ids, past_key_values, attention_mask):
+        """
+        Feeds one new token per row on top of past_key_values.
+        :return: same as _prefill
+        """
+        input_ids = input_ids.unsqueeze(-1)
+        return self._extend_ids(input_ids, torch.ones_like(attention_mask[:, :1]), past_key_values, attention_mask)
+
+    def _extend_ids(self, input_ids, new_mask, past_key_values, attention_mask):
+        """
+        Feeds text-only tokens (bs, len) on top of past_key_values. Padding in new_mask sits
+        between the cached tokens and the new ones and is masked out.
+        :return: same as _prefill
+        """
+        attention_mask = torch.cat([attention_mask, new_mask.to(attention_mask.dtype)], dim=1)
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)[:, -input_ids.shape[1]:]
+        inputs_embeds = self.llm.model.embed_tokens(input_ids) * self.llm.config.scale_emb
+        output = self.llm(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True
+        )
+        return output.logits[:, -1], output.past_key_values, attention_mask
+
+    def _prefill_prefix(self, tokenizer, data_list, vision_hidden_states, prefix_cache, group):
+        """
+        Same as _prefill for prompts that all see the same vision_hidden_states (or [] for none), but starts
+        from the kv cache of their longest common token prefix, kept in prefix_cache[group] across calls.
+        A cached prefix is truncated to what it shares with the new prompts and extended from there,
+        so the image block is only run through the llm once per image. The image block has the same ids
+        for every image, so an entry is only reused for the vision_hidden_states it was built with.
+        """
+        with self._stage('prompt'):
+            ids_list = self._tokenize(tokenizer, data_list, 2048)
+        # at least one token per row has to be fed to get its logits
+        target = ids_list[0][: min(len(ids) for ids in ids_list) - 1]
+        for ids in ids_list[1:]:
+            target = target[: common_prefix_len(target, ids)]
+        # the image block must lie inside the shared prefix, suffixes are embedded as text only
+        need = 0
+        if len(vision_hidden_states) > 0:
+            need = max((i + 1 for i, t in enumerate(ids_list[0]) if t == tokenizer.im_end_id), default=0)
+        if len(target) < need or len(target) == 0:
+            return self._prefill(tokenizer, data_list, [vision_hidden_states] * len(data_list), max_inp_length=2048)
+
+        cached_ids, past_key_values, cached_vhs = prefix_cache.get(group, ([], None, []))
+        shared = common_prefix_len(cached_ids, target) if same_vision(cached_vhs, vision_hidden_states) else 0
+        device = self.device
+        if shared < max(need, 1):
+            model_inputs = self._pad_ids(tokenizer, [target])
+            model_inputs['vision_hidden_states'] = [vision_hidden_states]
+            inputs_embeds, _ = self.get_vllm_embedding(model_inputs)
+            output = self.llm(
+                inputs_embeds=inputs_embeds,
+                position_ids=torch.arange(len(target), device=device).unsqueeze(0),
+                use_cache=True
+            )
+            past_key_values = output.past_key_values
+        else:
+            past_key_values = trim_cache(past_key_values, 0, shared)
+            if shared < len(target):
+                new_ids = torch.tensor([target[shared:]], dtype=torch.int32, device=device)
+                _, past_key_values, _ = self._extend_ids(
+                    new_ids, torch.ones_like(new_ids), past_key_values, torch.ones((1, shared), dtype=torch.long, device=device)
+                )
+        prefix_cache[group] = (target, past_key_values, vision_hidden_states)
+
+        # fork the prefix for every prompt and feed the left-padded suffixes
+        suffixes = self._pad_ids(tokenizer, [ids[len(target):] for ids in ids_list])
+        bs = len(ids_list)
+        past_key_values = reorder_cache(past_key_values, torch.zeros(bs, dtype=torch.long, device=device))
+        return self._extend_ids(
+            suffixes['input_ids'], suffixes['attention_mask'], past_key_values,
+            torch.ones((bs, len(target)), dtype=torch.long, device=device)
+        )
+
+    def _prefill_chat(self, tokenizer, prompts, vision_hidden_states, img_contrast=False, prefix_cache=None):
+        """
+        Prefills the rows [exp, txt] (or [exp, txt, img] with img_contrast) of one Chat call.
+        With a prefix_cache (a dict, one per image), the image rows and the text row each start from
+        a cached prefix, see _prefill_prefix.
+        """
+        image_rows = [prompts['exp']] + ([prompts['img']] if img_contrast else [])
+        if prefix_cache is None:
+            data_list = [prompts['exp'], prompts['txt']] + image_rows[1:]
+            vhs = [vision_hidden_states[0], []] + [vision_hidden_states[0]] * len(image_rows[1:])
+            return self._prefill(tokenizer, data_list, vhs, max_inp_length=2048)
+
+        image_state = self._prefill_prefix(tokenizer, image_rows, vision_hidden_states[0], prefix_cache, 'image')
+        text_state = self._prefill_prefix(tokenizer, [prompts['txt']], [], prefix_cache, 'text')
+        logits, past_key_values, attention_mask = merge_states([image_state, text_state])
+        # [exp, img, txt] -> [exp, txt, img]
+        order = torch.tensor([0, len(image_rows)] + list(range(1, len(image_rows))), device=logits.device)
+        return logits[order], reorder_cache(past_key_values, order), attention_mask[order]
+
+    def _contrast(self, logits_exp, logits_txt, txt_hp, tokenizer, logits_img=None, img_hp=0.0):
+        """
+        Batched version of the combination in Chat, with the img amateur of the commented-out branch.
+        :param txt_hp: float, or tensor (bs, 1) for a per-row weight
+        :return: contrasted logprobs (bs, vocab), whether the expert stops (bs,)
+        """
+        logits_exp = logits_exp.float()
+        probs_exp = torch.softmax(logits_exp, dim=-1)
+        logprobs_exp = F.log_softmax(logits_exp, dim=-1)
+        logprobs_exp[probs_exp < probs_exp.max(dim=-1, keepdim=True).values * self.plaus_hp] = float('-inf')
+        logprobs = logprobs_exp - txt_hp * amateur_logprobs(logits_txt, tokenizer)
+        if logits_img is not None:
+            logprobs = logprobs - img_hp * amateur_logprobs(logits_img, tokenizer)
+        return logprobs, stop_mask(logits_exp.argmax(-1), tokenizer)
+
     def chat(self, image, msgs, context, tokenizer, vision_hidden_states=None, max_new_tokens=2048, sampling=False, **kwargs):
         if isinstance(msgs, str):
             msgs = json.loads(msgs)
@@ -355,9 +545,7 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
 
         return answer, context, generation_config
 
-    def Chat(self, image, src_text, tokenizer, tgt_lang='en', txt_hp=0.0, img_hp=0.0, vision_hidden_states=None, **kwargs):
-        print('txt_hp', txt_hp, 'img_hp', img_hp)
-
+    def _chat_prompts(self, src_text, tokenizer, tgt_lang='en'):
         pre_prompt = tokenizer.im_start + tokenizer.unk_token * self.config.query_num + tokenizer.im_end + '\n<用户>'
         post_prompt = '\n<AI>'
         if tgt_lang == 'en':
@@ -379,69 +567,122 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
             }
         else: assert(False)
 
-        with torch.inference_mode():
-            gen_ids = []
-
-            for _ in range(1000):
-                # exp
-                res_exp, scores_exp, vision_hidden_states = self.Generate(
-                    data_list=[prompts['exp'] + tokenizer.decode(gen_ids)],
-                    max_inp_length=2048,
-                    img_list=[[image]],
-                    tokenizer=tokenizer,
-                    max_new_tokens=1,
-                    vision_hidden_states=vision_hidden_states,
-                    return_vision_hidden_states=True
-                )
-                if len(res_exp[0]) == 0:
-                    break
-                probs_exp = torch.softmax(scores_exp[0][0], dim=0)
-                max_prob = probs_exp.max()
-                logprobs_exp = F.log_softmax(scores_exp[0][0], dim=0)
-                logprobs_exp[probs_exp < max_prob * self.plaus_hp] = float('-inf')
-
-                # """
-                # txt
-                res_txt, scores_txt = self.Generate(
-                    data_list=[prompts['txt'] + tokenizer.decode(gen_ids)],
-                    max_inp_length=2048,
-                    img_list=None,
-                    tokenizer=tokenizer,
-                    max_new_tokens=1,
-                    vision_hidden_states=None,
-                    return_vision_hidden_states=False
-                )
-                if len(res_txt[0]) == 0:
-                    logprobs_txt = torch.zeros_like(logprobs_exp)
-                else:
-                    logprobs_txt = F.log_softmax(scores_txt[0][0], dim=0)
-                # """
-
-                """
-                # img
-                res_img, scores_img = self.Generate(
-                    data_list=[prompts['img'] + tokenizer.decode(gen_ids)],
-                    max_inp_length=2048,
-                    img_list=[[image]],
-                    tokenizer=tokenizer,
-                    max_new_tokens=1,
-                    vision_hidden_states=vision_hidden_states,
-                    return_vision_hidden_states=False
-                )
-                if len(res_img[0]) == 0:
-                    logprobs_img = torch.zeros_like(logprobs_exp)
-                else:
-                    logprobs_img = F.log_softmax(scores_img[0][0], dim=0)
-                """
-
-                # combine
-                # logprobs = logprobs_exp - txt_hp * logprobs_txt - img_hp * logprobs_img
-                logprobs = logprobs_exp - txt_hp * logprobs_txt
-                # logprobs = logprobs_exp - img_hp * logprobs_img
-                argmax_id = torch.argmax(logprobs)
-                gen_ids.append(argmax_id)
+        return prompts
 
-            return tokenizer.decode(gen_ids), vision_hidden_states
+    def Chat(self, image, src_text, tokenizer, tgt_lang='en', txt_hp=0.0, img_hp=0.0, vision_hidden_states=None, profiler=None, max_new_tokens=1000, num_beams=1, img_contrast=False, prefix_cache=None, trace=None, **kwargs):
+        """
+        Greedy contrastive decoding: exp - txt_hp * txt, re-running Generate on the full prompt each step.
+        num_beams > 1, img_contrast (adds - img_hp * img) or a prefix_cache (a dict shared by all calls
+        on the same image) switch to the kv cache path of Chat_stream / _contrast_beam_search.
+        trace (logit_trace.LogitTrace) records every greedy step, beam search is not supported.
+        """
+        print('txt_hp', txt_hp, 'img_hp', img_hp)
+        if trace is not None and num_beams > 1:
+            raise ValueError('trace only records greedy decoding, not num_beams > 1')
+        # stages: prompt, vision, expert, amateur, contrast
+        self.profiler = profiler
+
+        prompts = self._chat_prompts(src_text, tokenizer, tgt_lang)
+
+        try:
+            if num_beams > 1 or img_contrast or prefix_cache is not None:
+                if vision_hidden_states is None:
+                    vision_hidden_states = self.encode_image(image)
+                if num_beams > 1:
+                    res = self._contrast_beam_search(
+                        prompts, vision_hidden_states, tokenizer, txt_hp, num_beams, max_new_tokens,
+                        length_penalty=kwargs.get('length_penalty', 1.0),
+                        img_hp=img_hp if img_contrast else None, prefix_cache=prefix_cache
+                    )
+                else:
+                    gen_ids = [step['token_id'] for step in self.Chat_stream(
+                        image, src_text, tokenizer, tgt_lang=tgt_lang, txt_hp=txt_hp, img_hp=img_hp,
+                        vision_hidden_states=vision_hidden_states, max_new_tokens=max_new_tokens,
+                        img_contrast=img_contrast, prefix_cache=prefix_cache, trace=trace
+                    )]
+                    res = tokenizer.decode(gen_ids)
+                return res, vision_hidden_states
+
+            with torch.inference_mode():
+                gen_ids = []
+                if trace is not None:
+                    trace.begin(tgt_lang=tgt_lang, txt_hp=txt_hp, img_hp=0.0, plaus_hp=self.plaus_hp)
+
+                for _ in range(max_new_tokens):
+                    with self._stage('prompt'):
+                        gen_text = tokenizer.decode(gen_ids)
+
+                    # exp
+                    with self._stage('expert'):
+                        res_exp, scores_exp, vision_hidden_states = self.Generate(
+                            data_list=[prompts['exp'] + gen_text],
+                            max_inp_length=2048,
+                            img_list=[[image]],
+                            tokenizer=tokenizer,
+                            max_new_tokens=1,
+                            vision_hidden_states=vision_hidden_states,
+                            return_vision_hidden_states=True
+                        )
+                    if len(res_exp[0]) == 0:
+                        break
+                    with self._stage('contrast'):
+                        probs_exp = torch.softmax(scores_exp[0][0], dim=0)
+                        max_prob = probs_exp.max()
+                        logprobs_exp = F.log_softmax(scores_exp[0][0], dim=0)
+                        logprobs_exp[probs_exp < max_prob * self.plaus_hp] = float('-inf')
+
+                    # """
+                    # txt
+                    with self._stage('amateur'):
+                        res_txt, scores_txt = self.Generate(
+                            data_list=[prompts['txt'] + gen_text],
+                            max_inp_length=2048,
+                            img_list=None,
+                            tokenizer=tokenizer,
+                            max_new_tokens=1,
+                            vision_hidden_states=None,
+                            return_vision_hidden_states=False
+                        )
+                    if len(res_txt[0]) == 0:
+                        logprobs_txt = torch.zeros_like(logprobs_exp)
+                    else:
+                        logprobs_txt = F.log_softmax(scores_txt[0][0], dim=0)
+                    # """
+
+                    """
+                    # img
+                    res_img, scores_img = self.Generate(
+                        data_list=[prompts['img'] + gen_text],
+                        max_inp_length=2048,
+                        img_list=[[image]],
+                        tokenizer=tokenizer,
+                        max_new_tokens=1,
+                        vision_hidden_states=vision_hidden_states,
+                        return_vision_hidden_states=False
+                    )
+                    if len(res_img[0]) == 0:
+                        logprobs_img = torch.zeros_like(logprobs_exp)
+                    else:
+                        logprobs_img = F.log_softmax(scores_img[0][0], dim=0)
+                    """
+
+                    # combine
+                    with self._stage('contrast'):
+                        # logprobs = logprobs_exp - txt_hp * logprobs_txt - img_hp * logprobs_img
+                        logprobs = logprobs_exp - txt_hp * logprobs_txt
+                        # logprobs = logprobs_exp - img_hp * logprobs_img
+                        argmax_id = torch.argmax(logprobs)
+                    gen_ids.append(argmax_id)
+                    if profiler is not None:
+                        profiler.add_tokens()
+                    if trace is not None:
+                        trace.record(F.log_softmax(scores_exp[0][0], dim=0), logprobs_txt, torch.isfinite(logprobs_exp).sum(), argmax_id)
+
+                if trace is not None:
+                    trace.end()
+                return tokenizer.decode(gen_ids), vision_hidden_states
+        finally:
+            self.profiler = None
 
         """
         answer = res[0]
@@ -451,6 +692,211 @@ class MiniCPMV(MiniCPMVPreTrainedModel):
         return answer, context, scores
         """
 
+    def Chat_stream(self, image, src_text, tokenizer, tgt_lang='en', txt_hp=0.0, img_hp=0.0, vision_hidden_states=None,
+                    max_new_tokens=1000, stop_event=None, img_contrast=False, prefix_cache=None, trace=None):
+        """
+        Streaming variant of greedy Chat, decoding on a kv cache. Yields {'token_id', 'text'} per step,
+        where text is the newly detokenized piece (empty while a multi-byte character is incomplete).
+        Stop early by closing the generator or setting stop_event (e.g. a threading.Event).
+        """
+        prompts = self._chat_prompts(src_text, tokenizer, tgt_lang)
+        if vision_hidden_states is None:
+            vision_hidden_states = self.encode_image(image)
+        with torch.inference_mode(), self._stage('forward'):
+            logits, past_key_values, attention_mask = self._prefill_chat(
+                tokenizer, prompts, vision_hidden_states, img_contrast=img_contrast, prefix_cache=prefix_cache
+            )
+        m = len(logits)
+
+        gen_ids, text = [], ''
+        if trace is not None:
+            trace.begin(tgt_lang=tgt_lang, txt_hp=txt_hp, img_hp=img_hp if m > 2 else 0.0, plaus_hp=self.plaus_hp)
+        try:
+            for _ in range(max_new_tokens):
+                if stop_event is not None and stop_event.is_set():
+                    return
+                with torch.inference_mode(), self._stage('contrast'):
+                    logprobs, stop = self._contrast(logits[:1], logits[1:2], txt_hp, tokenizer, logits[2:] if m > 2 else None, img_hp)
+                    if stop[0]:
+                        break
+                    next_id = torch.argmax(logprobs, dim=-1)
+                    if trace is not None:
+                        trace.record(F.log_softmax(logits[0].float(), dim=-1), amateur_logprobs(logits[1], tokenizer),
+                                     torch.isfinite(logprobs[0]).sum(), next_id[0],
+                                     logprobs_img=amateur_logprobs(logits[2], tokenizer) if m > 2 else None)
+                gen_ids.append(next_id.item())
+                if self.profiler is not None:
+                    self.profiler.add_tokens()
+
+                new_text = tokenizer.decode(gen_ids)
+                delta = ''
+                if not new_text.endswith('\ufffd'):
+                    delta, text = new_text[len(text):], new_text
+                yield {'token_id': gen_ids[-1], 'text': delta}
+
+                with torch.inference_mode(), self._stage('forward'):
+                    logits, past_key_values, attention_mask = self._extend(next_id.repeat(m), past_key_values, attention_mask)
+        finally:
+            # also when the caller stops early
+            if trace is not None:
+                trace.end()
+
+    def _contrast_beam_search(self, prompts, vision_hidden_states, tokenizer, txt_hp, num_beams, max_new_tokens, length_penalty=1.0,
+                              img_hp=None, prefix_cache=None):
+        """
+        Beam search over the contrasted scores of Chat. All expert and amateur beams run in one
+        batched forward, rows [exp beam 0..n-1, txt beam 0..n-1, (img beam 0..n-1)], and the kv cache
+        is reordered when beams are selected. A beam ends when its expert would stop, as in greedy Chat.
+        """
+        with torch.inference_mode():
+            with self._stage('forward'):
+                logits, past_key_values, attention_mask = self._prefill_chat(
+                    tokenizer, prompts, vision_hidden_states, img_contrast=img_hp is not None, prefix_cache=prefix_cache
+                )
+            m = len(logits)
+            beams = [[]]
+            beam_scores = torch.zeros(1, device=logits.device)
+            finished = [] # [(normalized score, ids)]
+
+            for _ in range(max_new_tokens):
+                with self._stage('contrast'):
+                    n = len(beams)
+                    logprobs, stop = self._contrast(logits[:n], logits[n:2 * n], txt_hp, tokenizer,
+                                                    logits[2 * n:] if m > 2 else None, img_hp)
+                    for i in stop.nonzero().view(-1).tolist():
+                        finished.append((beam_scores[i].item() / max(len(beams[i]), 1) ** length_penalty, beams[i]))
+                    if len(finished) >= num_beams:
+                        break
+
+                    scores = (beam_scores.unsqueeze(-1) + logprobs).masked_fill(stop.unsqueeze(-1), float('-inf'))
+                    top_scores, top_idx = scores.view(-1).topk(num_beams)
+                    keep = torch.isfinite(top_scores)
+                    if not keep.any():
+                        break
+                    top_scores, top_idx = top_scores[keep], top_idx[keep]
+                    beam_idx = top_idx // scores.shape[-1]
+                    token_ids = top_idx % scores.shape[-1]
+                    beams = [beams[b] + [t] for b, t in zip(beam_idx.tolist(), token_ids.tolist())]
+                    beam_scores = top_scores
+
+                with self._stage('forward'):
+                    row_idx = torch.cat([beam_idx + b * n for b in range(m)])
+                    past_key_values = reorder_cache(past_key_values, row_idx)
+                    logits, past_key_values, attention_mask = self._extend(
+                        token_ids.repeat(m), past_key_values, attention_mask[row_idx]
+                    )
+                if self.profiler is not None:
+                    self.profiler.add_tokens()
+
+            if len(finished) < num_beams:
+                finished += [(score / max(len(ids), 1) ** length_penalty, ids) for score, ids in zip(beam_scores.tolist(), beams)]
+
+        return tokenizer.decode(max(finished, key=lambda x: x[0])[1])
+
+
+class ContrastBatch:
+    """
+    Continuously batched form of the greedy Chat loop. Requests join with add() and leave
+    once their expert stops; step() decodes one token for every request in the batch.
+    Rows of the kv cache are [exp 0..n-1, txt 0..n-1].
+
+    """
+    def __init__(self, model, tokenizer, max_new_tokens=1000):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+        self.requests = [] # [{key, txt_hp, gen_ids}]
+        self.logits = None
+        self.past_key_values = None
+        self.attention_mask = None
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, requests):
+        """
+        Prefills new requests and joins them into the running batch.
+        :param requests: list of dict with key, image, src_text, tgt_lang, txt_hp and optionally vision_hidden_states
+        """
+        if not requests:
+            return
+        model = self.model
+        n_new = len(requests)
+        prompts = [model._chat_prompts(req['src_text'], self.tokenizer, req.get('tgt_lang', 'en')) for req in requests]
+        vision_hidden_states = []
+        for req in requests:
+            vhs = req.get('vision_hidden_states')
+            if vhs is None:
+                vhs = model.encode_image(req['image'])
+            vision_hidden_states.append(vhs[0])
+        data_list = [p['exp'] for p in prompts] + [p['txt'] for p in prompts]
+        vision_hidden_states += [[] for _ in range(n_new)]
+
+        with torch.inference_mode():
+            logits, past_key_values, attention_mask = model._prefill(self.tokenizer, data_list, vision_hidden_states, max_inp_length=2048)
+
+            if self.requests:
+                # left pad both caches to the same length, then interleave to [exp old, exp new, txt old, txt new]
+                n_old = len(self.requests)
+                logits, past_key_values, attention_mask = merge_states([
+                    (self.logits, self.past_key_values, self.attention_mask),
+                    (logits, past_key_values, attention_mask)
+                ])
+                order = list(range(n_old)) + list(range(2 * n_old, 2 * n_old + n_new)) \
+                    + list(range(n_old, 2 * n_old)) + list(range(2 * n_old + n_new, 2 * (n_old + n_new)))
+                order = torch.tensor(order, device=logits.device)
+                past_key_values = reorder_cache(past_key_values, order)
+                attention_mask = attention_mask[order]
+                logits = logits[order]
+
+        self.logits, self.past_key_values, self.attention_mask = logits, past_key_values, attention_mask
+        self.requests += [{'key': req['key'], 'txt_hp': req.get('txt_hp', 0.0), 'gen_ids': []} for req in requests]
+
+    def step(self):
+        """
+        Decodes one token for every request and evicts the finished ones.
+        :return: list of (key, text) of requests that finished in this step
+        """
+        n = len(self.requests)
+        if n == 0:
+            return []
+        tokenizer = self.tokenizer
+        with torch.inference_mode():
+            txt_hp = torch.tensor([req['txt_hp'] for req in self.requests], device=self.logits.device).unsqueeze(-1)
+            logprobs, stop = self.model._contrast(self.logits[:n], self.logits[n:], txt_hp, tokenizer)
+            next_ids = torch.argmax(logprobs, dim=-1)
+
+            finished, keep = [], []
+            for i, (req, s, t) in enumerate(zip(self.requests, stop.tolist(), next_ids.tolist())):
+                if not s:
+                    req['gen_ids'].append(t)
+                if s or len(req['gen_ids']) >= self.max_new_tokens:
+                    finished.append((req['key'], tokenizer.decode(req['gen_ids'])))
+                else:
+                    keep.append(i)
+
+            self.requests = [self.requests[i] for i in keep]
+            if not keep:
+                self.logits = self.past_key_values = self.attention_mask = None
+                return finished
+
+            keep = torch.tensor(keep, device=next_ids.device)
+            row_idx = torch.cat([keep, keep + n])
+            past_key_values, attention_mask = self.past_key_values, self.attention_mask
+            if len(keep) < n:
+                past_key_values = reorder_cache(past_key_values, row_idx)
+                attention_mask = attention_mask[row_idx]
+                # drop columns that are padding for every remaining row
+                start = int((attention_mask.sum(0) > 0).long().argmax())
+                past_key_values = trim_cache(past_key_values, start)
+                attention_mask = attention_mask[:, start:]
+            self.logits, self.past_key_values, self.attention_mask = self.model._extend(
+                # next_ids has one entry per request, fed to both its exp and txt rows
+                next_ids[keep].repeat(2), past_key_values, attention_mask
+            )
+        return finished
+
+
 class LlamaTokenizerWrapper(LlamaTokenizer):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -510,21 +956,77 @@ def pad(orig_items, key, max_length=None, padding_value=0, padding_side="left"):
     elif dim == 2:
         if max_length == min_length:
             return torch.cat([item[key] for item in items], dim=0)
-        tensor = torch.zeros((batch_size, max_length), dtype=dtype) + padding_value
+        tensor = torch.full((batch_size, max_length), padding_value, dtype=dtype)
     else:
-        tensor = torch.zeros((batch_size, max_length, shape[-1]), dtype=dtype) + padding_value
+        tensor = torch.full((batch_size, max_length, shape[-1]), padding_value, dtype=dtype)
 
+    # slice assignment already copies, no need to clone
     for i, item in enumerate(items):
-        if dim == 2:
-            if padding_side == "left":
-                tensor[i, -len(item[key][0]):] = item[key][0].clone()
-            else:
-                tensor[i, : len(item[key][0])] = item[key][0].clone()
-        elif dim == 3:
-            if padding_side == "left":
-                tensor[i, -len(item[key][0]):, :] = item[key][0].clone()
-            else:
-                tensor[i, : len(item[key][0]), :] = item[key][0].clone()
+        if padding_side == "left":
+            tensor[i, -len(item[key][0]):] = item[key][0]
+        else:
+            tensor[i, : len(item[key][0])] = item[key][0]
 
     return tensor
 
+
+def stop_mask(ids, tokenizer):
+    # tokens that _Decode_text strips, i.e. where Chat stops
+    return (ids == 0) | (ids == tokenizer.eos_id) | (ids == tokenizer.bos_id)
+
+
+def amateur_logprobs(logits, tokenizer):
+    # an amateur that would stop does not take part in the contrast
+    logprobs = F.log_softmax(logits.float(), dim=-1)
+    return logprobs.masked_fill(stop_mask(logits.argmax(-1), tokenizer).unsqueeze(-1), 0.)
+
+
+def same_vision(a, b):
+    # vision_hidden_states tensors, or [] for text only rows
+    if a is b or (len(a) == 0 and len(b) == 0):
+        return True
+    return isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor) and a.shape == b.shape and torch.equal(a, b.to(a.device))
+
+
+def common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def reorder_cache(past_key_values, index):
+    """Selects rows of a kv cache (legacy tuple format or transformers Cache)."""
+    if hasattr(past_key_values, 'reorder_cache'):
+        past_key_values.reorder_cache(index)
+        return past_key_values
+    return tuple(tuple(t.index_select(0, index.to(t.device)) for t in layer) for layer in past_key_values)
+
+
+# the helpers below only handle the legacy tuple format, which MiniCPM returns when called without a Cache
+def pad_cache(past_key_values, length):
+    """Left pads every (bs, heads, seq, dim) tensor of a kv cache to seq == length."""
+    return tuple(tuple(F.pad(t, (0, 0, length - t.shape[2], 0)) for t in layer) for layer in past_key_values)
+
+
+def cat_cache(caches):
+    return tuple(tuple(torch.cat(ts) for ts in zip(*layers)) for layers in zip(*caches))
+
+
+def trim_cache(past_key_values, start, end=None):
+    if start == 0 and end is None:
+        return past_key_values
+    return tuple(tuple(t[:, :, start:end] for t in layer) for layer in past_key_values)
+
+
+def merge_states(states):
+    """
+    Concatenates the rows of several (logits, past_key_values, attention_mask) as returned by
+    _prefill, left padding the caches to a common length.
+    """
+    length = max(mask.shape[1] for _, _, mask in states)
+    logits = torch.cat([s[0] for s in states])
+    past_key_values = cat_cache([pad_cache(s[1], length) for s in states])
+    attention_mask = torch.cat([F.pad(s[2], (length - s[2].shape[1], 0)) for s in states])
+    return logits, past_key_values, attention_mask
@@ -0,0 +1,103 @@
+"""ONNX export of the vision path (vpm.forward_features + resampler) and an ONNX Runtime cpu backend for it.
+
+python onnx_vision.py --out save/vision.onnx
+
+exports with a dynamic batch dimension, checks parity against the eager float32 modules and times both.
+Use it with model.vision_backend = OnnxVisionEncoder('save/vision.onnx').
+"""
+import argparse
+import copy
+import time
+
+import torch
+
+
+class VisionEncoder(torch.nn.Module):
+    """get_vision_embedding as a single batched module"""
+    def __init__(self, model):
+        super().__init__()
+        self.vpm = model.vpm
+        self.resampler = model.resampler
+
+    def forward(self, pixel_values):
+        vision_embedding = self.vpm.forward_features(pixel_values)
+        if hasattr(self.vpm, 'num_prefix_tokens') and self.vpm.num_prefix_tokens > 0:
+            vision_embedding = vision_embedding[:, self.vpm.num_prefix_tokens:]
+        return self.resampler(vision_embedding)
+
+
+def eager_encoder(model):
+    # float32 cpu copy, leaves the model itself where it is
+    return copy.deepcopy(VisionEncoder(model)).float().cpu().eval()
+
+
+def export_vision(model, path, opset=17):
+    encoder = eager_encoder(model)
+    size = model.config.image_size
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder,
+            torch.randn(2, 3, size, size),
+            path,
+            input_names=['pixel_values'],
+            output_names=['vision_hidden_states'],
+            dynamic_axes={'pixel_values': {0: 'batch'}, 'vision_hidden_states': {0: 'batch'}},
+            opset_version=opset
+        )
+
+
+class OnnxVisionEncoder:
+    """
+    ONNX Runtime (cpu execution provider) replacement for the eager vision path, set as
+    MiniCPMV.vision_backend. Takes pixel values (bs, 3, h, w) and returns (bs, query_num, embed_dim).
+
+    """
+    def __init__(self, path, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, pixel_values):
+        pixel_values = pixel_values.detach().float().cpu().numpy()
+        return torch.from_numpy(self.session.run(None, {'pixel_values': pixel_values})[0])
+
+
+def check_parity(model, backend, batch_size=2, atol=1e-3, seed=0):
+    """max abs / rel difference between backend and the eager float32 modules on random pixels"""
+    size = model.config.image_size
+    pixel_values = torch.randn(batch_size, 3, size, size, generator=torch.Generator().manual_seed(seed))
+    with torch.no_grad():
+        ref = eager_encoder(model)(pixel_values)
+    got = backend(pixel_values)
+    max_abs = (ref - got).abs().max().item()
+    return {'max_abs': max_abs, 'max_rel': max_abs / ref.abs().max().item(), 'ok': max_abs <= atol}
+
+
+if __name__ == '__main__':
+    from loading import fast_load
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='openbmb/MiniCPM-V')
+    parser.add_argument('--out', default='save/vision.onnx')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--batch_size', type=int, default=4)
+    args = parser.parse_args()
+
+    model, _ = fast_load(args.model, device='cpu', dtype=torch.float32)
+    export_vision(model, args.out, opset=args.opset)
+    backend = OnnxVisionEncoder(args.out)
+    print('parity', check_parity(model, backend))
+
+    size = model.config.image_size
+    pixel_values = torch.randn(args.batch_size, 3, size, size)
+    with torch.inference_mode():
+        for name, fn in [('eager', lambda: model.get_vision_embedding(pixel_values, backend='eager')),
+                         ('onnx', lambda: backend(pixel_values))]:
+            fn()
+            t = time.perf_counter()
+            fn()
+            print(name, round((time.perf_counter() - t) / args.batch_size, 3), 's / image')
@@ -0,0 +1,63 @@
+"""Writes the resized uint8 pixels of a dataset into one memory-mapped .npy file with an id index,
+so runs skip jpeg decoding and the bicubic resize of MiniCPMV.transform.
+
+python preprocess.py --src shrunk-5/ --out save/pixels-448 --image_size 448
+
+writes save/pixels-448.npy (n, image_size, image_size, 3) and save/pixels-448.json {img_id: row}
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+
+class PixelStore:
+    """
+    Read side of preprocess.py. store[img_id] is a (image_size, image_size, 3) uint8 view into the
+    memory-mapped file, which MiniCPMV.generate / Generate / Chat accept in place of a PIL image.
+
+    """
+    def __init__(self, path):
+        # copy-on-write so the views are writable for torch without copying
+        self.pixels = np.load(path + '.npy', mmap_mode='c')
+        with open(path + '.json') as f:
+            self.index = json.load(f)
+
+    def __getitem__(self, img_id):
+        return self.pixels[self.index[img_id]]
+
+    def __contains__(self, img_id):
+        return img_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+
+def resize(image, image_size):
+    # the resize step of MiniCPMV.init_transform, torchvision resizes PIL images with PIL
+    return np.asarray(image.convert('RGB').resize((image_size, image_size), Image.BICUBIC), dtype=np.uint8)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--src', default='shrunk-5/')
+    parser.add_argument('--out', default='save/pixels-448')
+    parser.add_argument('--image_size', type=int, default=448, help='config.image_size of the model')
+    args = parser.parse_args()
+
+    fnames = sorted(os.listdir(args.src))
+    pixels = np.lib.format.open_memmap(args.out + '.npy', mode='w+', dtype=np.uint8,
+                                       shape=(len(fnames), args.image_size, args.image_size, 3))
+    index = {}
+    for i, fname in enumerate(fnames):
+        pixels[i] = resize(Image.open(os.path.join(args.src, fname)), args.image_size)
+        index[os.path.splitext(fname)[0]] = i
+    pixels.flush()
+    with open(args.out + '.json', 'w') as f:
+        json.dump(index, f)
+    print(len(index), 'images ->', args.out + '.npy')
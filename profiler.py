@@ -0,0 +1,84 @@
+import json
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+
+class Profiler:
+    """
+    Records per-stage wall time, generated tokens and peak memory for Chat calls.
+    Stages nest, so a stage's time includes the stages opened inside it.
+
+    """
+    def __init__(self, sync_cuda=True):
+        # synchronize before reading the clock so gpu kernels are attributed to the right stage
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.events = [] # [(name, start, dur)]
+        self.n_tokens = 0
+        self._t0 = time.perf_counter()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.events.append((name, start - self._t0, self._now() - start))
+
+    def add_tokens(self, n=1):
+        self.n_tokens += n
+
+    def summary(self):
+        totals = defaultdict(float)
+        counts = defaultdict(int)
+        for name, _, dur in self.events:
+            totals[name] += dur
+            counts[name] += 1
+        wall = time.perf_counter() - self._t0
+
+        # ru_maxrss is in KB on linux
+        res = {
+            'wall_s': wall,
+            'n_tokens': self.n_tokens,
+            'tokens_per_s': self.n_tokens / wall if wall > 0 else 0.0,
+            'peak_cpu_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'stages': {name: {'total_s': totals[name], 'count': counts[name], 'mean_ms': 1000 * totals[name] / counts[name]}
+                       for name in totals},
+        }
+        if torch.cuda.is_available():
+            res['peak_gpu_mb'] = torch.cuda.max_memory_allocated() / 2**20
+        return res
+
+    def save_summary(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def save_chrome_trace(self, path):
+        # open in chrome://tracing or https://ui.perfetto.dev
+        trace = [{
+            'name': name,
+            'ph': 'X',
+            'ts': start * 1e6,
+            'dur': dur * 1e6,
+            'pid': 0,
+            'tid': 0,
+        } for name, start, dur in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def print_summary(self):
+        s = self.summary()
+        print('wall', round(s['wall_s'], 2), 's', 'tokens', s['n_tokens'], 'tok/s', round(s['tokens_per_s'], 2))
+        print('peak cpu', round(s['peak_cpu_mb']), 'MB', 'peak gpu', round(s.get('peak_gpu_mb', 0)), 'MB')
+        for name, st in sorted(s['stages'].items(), key=lambda x: -x[1]['total_s']):
+            print(f"{name:>10} {st['total_s']:9.2f} s {st['count']:7d} x {st['mean_ms']:9.2f} ms")
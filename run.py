@@ -1,24 +1,28 @@
 import torch
 from PIL import Image
-from transformers import AutoModel, AutoTokenizer
-import pandas as pd
+from transformers import AutoTokenizer
 import os
 import pickle
 import random
 
+from profiler import Profiler
+from preprocess import PixelStore
+from captions import get_caption
+from loading import fast_load
+from logit_trace import LogitTrace
+
 # load model
 print('cuda available', torch.cuda.is_available())
-model = AutoModel.from_pretrained('openbmb/MiniCPM-V', trust_remote_code=True, torch_dtype=torch.bfloat16)
-model = model.to(device='cuda:0', dtype=torch.bfloat16)
-tokenizer = AutoTokenizer.from_pretrained('openbmb/MiniCPM-V', trust_remote_code=True)
+model_name = 'openbmb/MiniCPM-V'
+model, load_times = fast_load(model_name, device='cuda:0', dtype=torch.bfloat16)
+print('load times', {k: round(v, 2) for k, v in load_times.items()})
+tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
 model.eval()
 
-# read captions
-cap_jsonl = pd.read_json('captions.jsonl', lines=True)
-def get_caption(img_id, lang, idx=0):
-    return cap_jsonl[cap_jsonl['image/key'] == img_id][lang].iloc[0]['caption'][idx]
-
 dire = 'shrunk-5/'
+# resized pixels written by preprocess.py, skips jpeg decoding and resizing
+pixels_path = 'save/pixels-448'
+pixels = PixelStore(pixels_path) if os.path.exists(pixels_path + '.npy') else None
 dirs = [('en', 'zh'), ('zh', 'en')]
 n_dir = len(dirs)
 # direction -> {hp_i -> {img_id -> res}}
@@ -31,12 +35,45 @@ random.seed(17)
 random.shuffle(fnames)
 sample_fnames = fnames[:100]
 
-# run
+run_name = 'run6'
+profiler = Profiler()
+# per-step top-k logprobs of both branches, for offline analysis with logit_trace.rescore
+trace = LogitTrace()
+
+# phase 1: encode every image, then free the vision tower so decoding runs with only the llm resident
+# cached per img_id, only valid for the same weights and image source
+vision_path = f'save/{run_name}_vision.pt'
+vision_meta = {
+    'model': model_name,
+    'revision': getattr(model.config, '_commit_hash', None),
+    'pixels': pixels_path if pixels is not None else dire,
+    'pixels_mtime': os.path.getmtime(pixels_path + '.npy') if pixels is not None else None,
+}
+vision = {} # img_id -> vision_hidden_states
+if os.path.exists(vision_path):
+    cached = torch.load(vision_path, map_location=model.device)
+    if cached.get('meta') == vision_meta:
+        vision = cached['vision']
+missing = [fname for fname in sample_fnames if fname[:-4] not in vision]
+# Chat sets the profiler for its own calls, encode_image needs it set here to record the vision stages
+model.profiler = profiler
+for fname in missing:
+    img_id = fname[:-4]
+    if pixels is not None and img_id in pixels:
+        image = pixels[img_id]
+    else:
+        image = Image.open(dire + fname).convert('RGB')
+    vision[img_id] = model.encode_image(image)
+model.profiler = None
+if missing:
+    torch.save({'meta': vision_meta, 'vision': vision}, vision_path)
+model.offload_vision()
+
+# phase 2: contrastive decoding
 # for fname in os.listdir(dire):
 for fname in sample_fnames:
-    image = Image.open(dire + fname).convert('RGB')
     img_id = fname[:-4]
-    vision_hidden_states = None
+    vision_hidden_states = vision[img_id]
 
     for dirn in dirs:
         src_lang, tgt_lang = dirn
@@ -44,16 +81,24 @@ for fname in sample_fnames:
 
         for hp_i in range(n_hp):
             hp = hp_i * 0.01
+            trace.context = {'img_id': img_id, 'src_lang': src_lang, 'hp_i': hp_i}
             res_run, vision_hidden_states = model.Chat(
-                image=image,
+                image=None,
                 src_text=src_text,
                 tokenizer=tokenizer,
                 tgt_lang=tgt_lang,
                 txt_hp=hp,
                 img_hp=hp,
-                vision_hidden_states=vision_hidden_states
+                vision_hidden_states=vision_hidden_states,
+                profiler=profiler,
+                trace=trace
             )
             res[dirn][hp_i][img_id] = res_run
 
-with open('save/run6.pkl', 'wb') as f:
+with open(f'save/{run_name}.pkl', 'wb') as f:
     pickle.dump(res, f)
+
+profiler.print_summary()
+profiler.save_summary(f'save/{run_name}_profile.json')
+profiler.save_chrome_trace(f'save/{run_name}_trace.json')
+trace.save(f'save/{run_name}_logits.npz')
@@ -0,0 +1,155 @@
+"""Local http server for contrastive caption translation with continuous batching.
+
+python server.py --port 8000 --max_batch 16
+
+curl localhost:8000/chat -d '{"image": "shrunk-5/<img_id>.jpg", "src_text": "...", "tgt_lang": "zh", "txt_hp": 0.03}'
+-> {"text": "..."}
+
+image is a path readable by the server or base64 encoded image bytes in image_b64.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+from transformers import AutoModel, AutoTokenizer
+
+
+class Scheduler:
+    """
+    Feeds queued requests into a ContrastBatch between decode steps, so new requests join
+    the running batch and finished ones leave it without waiting for the rest.
+    The model runs in a single worker thread, the event loop only schedules.
+
+    """
+    def __init__(self, model, tokenizer, max_batch=16, max_new_tokens=1000):
+        # ContrastBatch lives in the remote code module the model was loaded from
+        contrast_batch = sys.modules[type(model).__module__].ContrastBatch
+        self.new_batch = lambda: contrast_batch(model, tokenizer, max_new_tokens=max_new_tokens)
+        self.batch = self.new_batch()
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.futures = {} # key -> future
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # image decoding, kept off both the event loop and the model worker
+        self.io_executor = ThreadPoolExecutor()
+        self._next_key = 0
+
+    async def submit(self, image, src_text, tgt_lang='en', txt_hp=0.0):
+        key = self._next_key
+        self._next_key += 1
+        future = asyncio.get_running_loop().create_future()
+        self.futures[key] = future
+        await self.queue.put({'key': key, 'image': image, 'src_text': src_text, 'tgt_lang': tgt_lang, 'txt_hp': txt_hp})
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            new = []
+            if len(self.batch) == 0:
+                # idle until a request arrives
+                new.append(await self.queue.get())
+            while not self.queue.empty() and len(self.batch) + len(new) < self.max_batch:
+                new.append(self.queue.get_nowait())
+            try:
+                if new:
+                    await loop.run_in_executor(self.executor, self.batch.add, new)
+                finished = await loop.run_in_executor(self.executor, self.batch.step)
+            except Exception as e:
+                # fail the requests in flight rather than leave clients hanging, queued ones still run
+                keys = [req['key'] for req in self.batch.requests] + [req['key'] for req in new]
+                for key in keys:
+                    future = self.futures.pop(key, None)
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                self.batch = self.new_batch()
+                continue
+            for key, text in finished:
+                future = self.futures.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_result(text)
+
+
+def load_image(req):
+    if 'image_b64' in req:
+        return Image.open(io.BytesIO(base64.b64decode(req['image_b64']))).convert('RGB')
+    return Image.open(req['image']).convert('RGB')
+
+
+async def respond(writer, status, obj):
+    body = json.dumps(obj, ensure_ascii=False).encode()
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=utf-8\r\n'
+                 f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    await writer.drain()
+    writer.close()
+
+
+def make_handler(scheduler):
+    async def handle(reader, writer):
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        except (ValueError, asyncio.IncompleteReadError):
+            return await respond(writer, 400, {'error': 'malformed request'})
+
+        if len(request_line) < 2:
+            return await respond(writer, 400, {'error': 'malformed request'})
+        method, path = request_line[:2]
+        if method == 'GET' and path == '/health':
+            return await respond(writer, 200, {'batch': len(scheduler.batch), 'queued': scheduler.queue.qsize()})
+        if method != 'POST' or path != '/chat':
+            return await respond(writer, 404, {'error': f'no route {method} {path}'})
+
+        try:
+            req = json.loads(body)
+            image = await asyncio.get_running_loop().run_in_executor(scheduler.io_executor, load_image, req)
+            tgt_lang = req.get('tgt_lang', 'en')
+            assert tgt_lang in ['en', 'zh'], tgt_lang
+            args = (image, req['src_text'], tgt_lang, float(req.get('txt_hp', 0.0)))
+        except (ValueError, KeyError, OSError, AssertionError) as e:
+            return await respond(writer, 400, {'error': repr(e)})
+        try:
+            text = await scheduler.submit(*args)
+        except Exception as e:
+            return await respond(writer, 500, {'error': repr(e)})
+        await respond(writer, 200, {'text': text})
+    return handle
+
+
+async def main(args):
+    print('cuda available', torch.cuda.is_available())
+    model = AutoModel.from_pretrained(args.model, trust_remote_code=True, torch_dtype=torch.bfloat16)
+    model = model.to(device=args.device, dtype=torch.bfloat16)
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    model.eval()
+
+    scheduler = Scheduler(model, tokenizer, max_batch=args.max_batch, max_new_tokens=args.max_new_tokens)
+    server = await asyncio.start_server(make_handler(scheduler), args.host, args.port)
+    print('serving on', args.host, args.port)
+    async with server:
+        await asyncio.gather(server.serve_forever(), scheduler.run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='openbmb/MiniCPM-V')
+    parser.add_argument('--device', default='cuda:0')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch', type=int, default=16)
+    parser.add_argument('--max_new_tokens', type=int, default=1000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,51 @@
+import numpy as np
+
+
+def paired_bootstrap(scores, n_resamples=1000, alpha=0.05, seed=0):
+    """
+    Paired bootstrap resampling of items for all systems (e.g. hp settings) at once.
+    Every resample draws the same items for every system; a resample is stored as item counts,
+    so the resampled corpus scores of all systems are a single matrix product.
+    :param scores: array (n_systems, n_items) of per-item scores on the same items, e.g. the scores
+                   array of CiderScorer.compute_score or COMET segment scores, one row per hp_i
+    :return: dict with
+        mean (n_systems,)               corpus score, the mean over items
+        ci (n_systems, 2)               percentile confidence interval at level 1 - alpha
+        win (n_systems, n_systems)      fraction of resamples where system i scores above system j
+        p (n_systems, n_systems)        one-sided p-value for "i is better than j", 1 - win
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    n_items = scores.shape[1]
+    rng = np.random.default_rng(seed)
+    counts = rng.multinomial(n_items, np.full(n_items, 1.0 / n_items), size=n_resamples) # (n_resamples, n_items)
+    means = scores @ counts.T / n_items # (n_systems, n_resamples)
+
+    win = (means[:, None, :] > means[None, :, :]).mean(-1)
+    return {
+        'mean': scores.mean(-1),
+        'ci': np.percentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=-1).T,
+        'win': win,
+        'p': 1 - win,
+    }
+
+
+def compare_hps(img_scores, n_resamples=1000, alpha=0.05, seed=0):
+    """
+    :param img_scores: direction -> {hp_i -> per-image scores}, as returned by eval_cider / eval_comet
+                       with return_img_scores=True
+    :return: direction -> paired_bootstrap result, systems ordered by hp_i
+    """
+    res = {}
+    for d, by_hp in img_scores.items():
+        hps = sorted(by_hp)
+        res[d] = paired_bootstrap(np.stack([by_hp[hp_i] for hp_i in hps]), n_resamples, alpha, seed)
+    return res
+
+
+def print_comparison(res, base=0, alpha=0.05):
+    """prints every hp_i against hp_i == base, * marks p < alpha"""
+    for d, r in res.items():
+        print('direction', d)
+        for i in range(len(r['mean'])):
+            mark = '*' if r['p'][i, base] < alpha else ''
+            print(f"  hp_i {i:2d} {r['mean'][i]:.4f} [{r['ci'][i, 0]:.4f}, {r['ci'][i, 1]:.4f}]  p(> hp_i {base}) {r['p'][i, base]:.3f}{mark}")
@@ -7,4 +7,9 @@ from eval import eval_cider, eval_comet, init_comet
 
 # init_comet()
 for l in [None, 'en', 'zh']:
-    print(eval_cider('run5', 2, lang_filter=l))
\ No newline at end of file
+    print(eval_cider('run5', 2, lang_filter=l))
+
+# paired bootstrap over the hp settings, see significance.py
+# from significance import compare_hps, print_comparison
+# scores, img_scores = eval_cider('run5', 2, return_img_scores=True)
+# print_comparison(compare_hps(img_scores))